@@ -1,7 +1,35 @@
+import asyncio
+import hashlib
 import logging
-from typing import Any, Dict
+from typing import Any, Dict, List, Optional
 
+import httpx
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _build_session() -> requests.Session:
+    # reaproveita conexões (keep-alive) com o base_url entre chamadas
+    session = requests.Session()
+    retry = Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"POST"}),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+_SESSION = _build_session()
+
+# máximo de endpoints buscados ao mesmo tempo por cliente
+FETCH_CONCURRENCY = 8
 
 
 def api_login(
@@ -19,11 +47,11 @@ def api_login(
         "identificador": (None, identificador),
     }
 
-    logger.info(f"Login: POST {url} (identificador={identificador})")
-    resp = requests.post(url, files=files, verify=verify_ssl, timeout=60)
+    logger.info("Login: POST %s (identificador=%s)", url, identificador)
+    resp = _SESSION.post(url, files=files, verify=verify_ssl, timeout=60)
     resp.raise_for_status()
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     if not data.get("resultado", False):
         raise RuntimeError(f"Login falhou: {data}")
 
@@ -33,7 +61,7 @@ def api_login(
     if not sessao or not id_usuario:
         raise RuntimeError(f"Resposta de login sem sessao/id_usuario: {data}")
 
-    logger.info(f"Login OK | id_usuario={id_usuario} | sessao={str(sessao)[:6]}...")
+    logger.info("Login OK | id_usuario=%s | sessao=%.6s...", id_usuario, sessao)
 
     return {
         "sessao": str(sessao),
@@ -43,33 +71,81 @@ def api_login(
     }
 
 
-def api_fetch_endpoint(
+def is_auth_error(result: Any) -> bool:
+    # sessão expirada/recusada num resultado de api_fetch_endpoints
+    return isinstance(result, httpx.HTTPStatusError) and result.response.status_code in (401, 403)
+
+
+async def api_fetch_endpoint(
+    client: httpx.AsyncClient,
     base_url: str,
     endpoint: str,
     sessao: str,
     idUsuario: str,
     identificador: str,
-    verify_ssl: bool,
-    logger: logging.Logger
-) -> Any:
+    logger: logging.Logger,
+    etag: Optional[str] = None
+) -> Dict[str, Any]:
     url = f"{base_url}/{endpoint}"
     files = {
         "sessao": (None, sessao),
         "idUsuario": (None, idUsuario),
         "identificador": (None, identificador),
     }
+    headers = {"If-None-Match": etag} if etag else None
 
-    logger.info(f"Fetch: POST {url}")
-    resp = requests.post(url, files=files, verify=verify_ssl, timeout=120)
+    logger.info("Fetch: POST %s", url)
+    resp = await client.post(url, files=files, headers=headers)
+    if etag and resp.status_code == 304:
+        return {"payload": None, "sha256": None, "etag": etag, "not_modified": True}
     resp.raise_for_status()
 
     try:
-        return resp.json()
+        payload = orjson.loads(resp.content)
     except Exception:
         text = resp.text
         raise RuntimeError(
             f"Endpoint {endpoint} retornou não-JSON. Conteúdo inicial: {text[:300]}"
         )
+
+    return {
+        "payload": payload,
+        "sha256": hashlib.sha256(resp.content).hexdigest(),
+        "etag": resp.headers.get("ETag"),
+        "not_modified": False
+    }
+
+
+async def api_fetch_endpoints(
+    base_url: str,
+    endpoints: List[str],
+    sessao: str,
+    idUsuario: str,
+    identificador: str,
+    verify_ssl: bool,
+    logger: logging.Logger,
+    etags: Optional[List[Optional[str]]] = None
+) -> List[Any]:
+    # busca os endpoints do cliente em paralelo; cada posição traz o resultado de api_fetch_endpoint
+    # ou a exceção daquele endpoint
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+    etags = etags or [None] * len(endpoints)
+
+    async with httpx.AsyncClient(http2=True, verify=verify_ssl, timeout=120) as client:
+        async def fetch(endpoint: str, etag: Optional[str]) -> Any:
+            async with sem:
+                return await api_fetch_endpoint(
+                    client=client,
+                    base_url=base_url,
+                    endpoint=endpoint,
+                    sessao=sessao,
+                    idUsuario=idUsuario,
+                    identificador=identificador,
+                    logger=logger,
+                    etag=etag
+                )
+
+        return await asyncio.gather(*(fetch(e, t) for e, t in zip(endpoints, etags)), return_exceptions=True)
     
     
 # nesse arquivo api_service.py você tem funções para fazer login na API e buscar dados de endpoints específicos. Essas funções lidam com requisições HTTP, Tratamento de erros e logging das operações realizadas.      
\ No newline at end of file
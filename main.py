@@ -1,8 +1,13 @@
+import asyncio
+import json
 import os
 import time
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple
 
 import yaml
 import psycopg
@@ -10,44 +15,82 @@ from psycopg import sql
 import urllib3
 from urllib3.exceptions import InsecureRequestWarning
 from dotenv import load_dotenv
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from api_service import api_login, api_fetch_endpoint
+from api_service import api_login, api_fetch_endpoints, is_auth_error
 from pg_service import (
     pg_conninfo_from_env,
+    pg_ensure_connection,
     table_name_from_endpoint,
     extract_rows_from_payload,
     insert_rows_batch,
     drop_all_tables_in_schema,
+    list_tables_in_schema,
 )
 
+# máximo de clientes processados em paralelo (um processo cada)
+MAX_CLIENT_WORKERS = 8
+
+# fila e listener do log, criados em setup_logger
+_LOG_QUEUE: Optional["multiprocessing.Queue"] = None
+_LOG_LISTENER: Optional[QueueListener] = None
+
+# conexão do processo do pool com o banco, reaproveitada entre os ciclos
+_WORKER_CONN: Optional[psycopg.Connection] = None
+
+# hash/etag do último payload gravado por endpoint; endpoint sem mudança não é regravado
+FETCH_STATE_PATH = ".etag.json"
+
+# (usuario, identificador) -> retorno do api_login + expires_at; vive entre os ciclos
+_AUTH_CACHE: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
 def setup_logger() -> logging.Logger:
+    # o logger só enfileira; a escrita em arquivo/console fica na thread do QueueListener.
+    # a fila é de multiprocessing para os processos do pool usarem o mesmo listener
+    global _LOG_QUEUE, _LOG_LISTENER
+
     os.makedirs("log", exist_ok=True)
 
     fname = datetime.now().strftime("log%d%m%Y.txt")
     path = os.path.join("log", fname)
 
-    logger = logging.getLogger("etl")
-    logger.setLevel(logging.INFO)
-    logger.handlers.clear()
+    stop_logger()
 
     handler = RotatingFileHandler(
         path,
-        maxBytes=10_000,
+        maxBytes=10_000_000,
         backupCount=50,
         encoding="utf-8"
     )
 
     fmt = logging.Formatter("%(asctime)s | %(levelname)s | %(message)s")
     handler.setFormatter(fmt)
-    logger.addHandler(handler)
 
     console = logging.StreamHandler()
     console.setFormatter(fmt)
-    logger.addHandler(console)
 
+    _LOG_QUEUE = multiprocessing.Queue()
+    _LOG_LISTENER = QueueListener(_LOG_QUEUE, handler, console)
+    _LOG_LISTENER.start()
+
+    return setup_worker_logger(_LOG_QUEUE)
+
+
+def setup_worker_logger(log_queue: "multiprocessing.Queue") -> logging.Logger:
+    logger = logging.getLogger("etl")
+    logger.setLevel(logging.INFO)
+    logger.handlers.clear()
+    logger.addHandler(QueueHandler(log_queue))
     return logger
 
+
+def stop_logger() -> None:
+    # descarrega o que ainda está na fila e para a thread do listener
+    global _LOG_LISTENER
+    if _LOG_LISTENER is not None:
+        _LOG_LISTENER.stop()
+        _LOG_LISTENER = None
+
 def load_clients(path: str = "clients.yml") -> List[Dict[str, Any]]:
     with open(path, "r", encoding="utf-8") as f:
         data = yaml.safe_load(f) or {}
@@ -63,6 +106,70 @@ def env_bool(key: str, default: bool = False) -> bool:
         return default
     return val.strip().lower() in ("1", "true", "yes", "y", "on")
 
+def get_auth(
+    base_url: str,
+    usuario: str,
+    senha: str,
+    identificador: str,
+    verify_ssl: bool,
+    logger: logging.Logger,
+    ttl_seconds: int
+) -> Dict[str, Any]:
+    key = (usuario, identificador)
+    cached = _AUTH_CACHE.get(key)
+    if cached and time.time() < cached["expires_at"] - 60:
+        logger.info("Login reaproveitado (identificador=%s)", identificador)
+        return cached
+
+    auth = api_login(
+        base_url=base_url,
+        usuario=usuario,
+        senha=senha,
+        identificador=identificador,
+        verify_ssl=verify_ssl,
+        logger=logger
+    )
+    auth["expires_at"] = time.time() + ttl_seconds
+    _AUTH_CACHE[key] = auth
+    return auth
+
+
+def fetch_endpoints(
+    base_url: str,
+    endpoints: List[str],
+    auth: Dict[str, Any],
+    verify_ssl: bool,
+    logger: logging.Logger,
+    etags: Optional[List[Optional[str]]] = None
+) -> List[Any]:
+    return asyncio.run(api_fetch_endpoints(
+        base_url=base_url,
+        endpoints=endpoints,
+        sessao=auth["sessao"],
+        idUsuario=auth["idUsuario"],
+        identificador=auth["identificador"],
+        verify_ssl=verify_ssl,
+        logger=logger,
+        etags=etags
+    ))
+
+
+def load_fetch_state(path: str = FETCH_STATE_PATH) -> Dict[str, Dict[str, Dict[str, Any]]]:
+    # schema -> endpoint -> {"table", "sha256", "etag"} da última gravação bem-sucedida
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_fetch_state(state: Dict[str, Dict[str, Dict[str, Any]]], path: str = FETCH_STATE_PATH) -> None:
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
 def drop_orphan_schemas(conn: psycopg.Connection, keep_schemas: List[str], logger: logging.Logger) -> int:
     keep = {s.strip() for s in keep_schemas if s and str(s).strip()}
 
@@ -77,27 +184,225 @@ def drop_orphan_schemas(conn: psycopg.Connection, keep_schemas: List[str], logge
               AND nspname <> 'information_schema'
         """)
         existing = [r[0] for r in cur.fetchall()]
+    conn.commit()
+
+    orphans = [s for s in existing if s not in keep and s not in protected]
+    if not orphans:
+        return 0
+
+    # todos os órfãos num único DROP SCHEMA; se falhar, tenta um a um para não travar os demais
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(
+                sql.SQL(", ").join(sql.Identifier(s) for s in orphans)
+            ))
+        conn.commit()
+        for s in orphans:
+            logger.info("Schema órfão removido: %s", s)
+        return len(orphans)
+    except Exception as e:
+        conn.rollback()
+        logger.warning("Falha ao remover schemas órfãos em lote (%s). Removendo um a um.", e)
 
     removed = 0
-    for s in existing:
-        if s in keep:
-            continue
-
-        if s in protected:
-            continue
-
+    for s in orphans:
         try:
             with conn.cursor() as cur:
                 cur.execute(sql.SQL("DROP SCHEMA IF EXISTS {} CASCADE").format(sql.Identifier(s)))
             conn.commit()
-            logger.info(f"Schema órfão removido: {s}")
+            logger.info("Schema órfão removido: %s", s)
             removed += 1
         except Exception as e:
-            logger.exception(f"Falha ao remover schema órfão '{s}': {e}")
+            conn.rollback()
+            logger.exception("Falha ao remover schema órfão '%s': %s", s, e)
 
     return removed
 
-def run_cycle(logger: logging.Logger) -> None:
+def _process_client(
+    client_cfg: Dict[str, Any],
+    base_url: str,
+    verify_ssl: bool,
+    conninfo: str,
+    unlogged_tables: bool,
+    session_ttl: int,
+    cached_auth: Optional[Dict[str, Any]],
+    fetch_state: Dict[str, Dict[str, Any]]
+) -> Tuple[Optional[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    # roda num processo do pool: conexão, sessão HTTP e logger próprios.
+    # recebe do processo pai o login em cache e o estado dos endpoints (hash/etag da última gravação)
+    # e devolve os dois atualizados
+    global _WORKER_CONN
+    logger = logging.getLogger("etl")
+    if not verify_ssl:
+        urllib3.disable_warnings(InsecureRequestWarning)
+
+    name = client_cfg.get("name", "SemNome")
+    schema = client_cfg.get("schema")
+    usuario = client_cfg.get("usuario")
+    senha = client_cfg.get("senha")
+    identificador = client_cfg.get("identificador")
+    endpoints = client_cfg.get("endpoints", [])
+
+    if not all([schema, usuario, senha, identificador]):
+        logger.error("Cliente '%s' inválido (faltando schema/usuario/senha/identificador). Pulando.", name)
+        return None, {}
+    if not endpoints:
+        logger.warning("Cliente '%s' sem endpoints. Pulando.", name)
+        return cached_auth, {}
+
+    logger.info("=== Cliente: %s | schema=%s ===", name, schema)
+
+    login = dict(
+        base_url=base_url,
+        usuario=str(usuario),
+        senha=str(senha),
+        identificador=str(identificador),
+        verify_ssl=verify_ssl,
+        logger=logger,
+        ttl_seconds=session_ttl
+    )
+    key = (login["usuario"], login["identificador"])
+    if cached_auth:
+        _AUTH_CACHE[key] = cached_auth
+
+    try:
+        auth = get_auth(**login)
+    except Exception as e:
+        logger.exception("Falha no login do cliente '%s': %s", name, e)
+        return None, fetch_state
+
+    # a conexão do processo fica aberta entre os ciclos
+    _WORKER_CONN = pg_ensure_connection(_WORKER_CONN, conninfo)
+    conn = _WORKER_CONN
+
+    targets = []
+    for ep in endpoints:
+        if isinstance(ep, str):
+            endpoint_name = ep
+            table = table_name_from_endpoint(endpoint_name)
+        elif isinstance(ep, dict):
+            endpoint_name = str(ep.get("endpoint", "")).strip()
+            custom_table = str(ep.get("table", "")).strip()
+
+            if not endpoint_name:
+                logger.error("Endpoint inválido no yml (faltando 'endpoint') no cliente '%s'. Pulando.", name)
+                continue
+
+            table = custom_table if custom_table else table_name_from_endpoint(endpoint_name)
+        else:
+            logger.error("Formato inválido em endpoints no cliente '%s': %s. Pulando.", name, ep)
+            continue
+        targets.append((str(endpoint_name), str(table)))
+
+    # só dá para pular um endpoint se a tabela gravada a partir dele ainda existe
+    existing_tables = set(list_tables_in_schema(conn, str(schema)))
+    conn.commit()
+    known = {
+        e: fetch_state[e] for e, t in targets
+        if e in fetch_state and fetch_state[e].get("table") == t and t in existing_tables
+    }
+
+    # If-None-Match só para tabela de um único endpoint: numa tabela compartilhada qualquer
+    # mudança obriga a recarregar todos os endpoints dela, então o corpo de cada um é necessário
+    table_count: Dict[str, int] = {}
+    for _, t in targets:
+        table_count[t] = table_count.get(t, 0) + 1
+
+    def etag_for(endpoint: str, table: str) -> Optional[str]:
+        return known.get(endpoint, {}).get("etag") if table_count[table] == 1 else None
+
+    payloads = fetch_endpoints(
+        base_url, [e for e, _ in targets], auth, verify_ssl, logger,
+        etags=[etag_for(e, t) for e, t in targets]
+    )
+
+    expired = [i for i, p in enumerate(payloads) if is_auth_error(p)]
+    if expired:
+        logger.info("Sessão do cliente '%s' recusada pela API. Refazendo login.", name)
+        _AUTH_CACHE.pop(key, None)
+        try:
+            auth = get_auth(**login)
+            retried = fetch_endpoints(
+                base_url, [targets[i][0] for i in expired], auth, verify_ssl, logger,
+                etags=[etag_for(*targets[i]) for i in expired]
+            )
+            for i, p in zip(expired, retried):
+                payloads[i] = p
+        except Exception as e:
+            logger.exception("Falha no novo login do cliente '%s': %s", name, e)
+
+    same = {
+        e for (e, _), result in zip(targets, payloads)
+        if e in known and not isinstance(result, Exception)
+        and (result["not_modified"] or result["sha256"] == known[e].get("sha256"))
+    }
+    # tabela compartilhada por vários endpoints só é mantida se nenhum deles mudou
+    changed_tables = {t for e, t in targets if e not in same}
+    unchanged = {e for e, t in targets if t not in changed_tables}
+
+    # as tabelas dos endpoints recebidos ficam: as sem alteração são mantidas e as demais
+    # são substituídas pela carga nova em insert_rows_batch
+    fetched = {t for (_, t), result in zip(targets, payloads) if not isinstance(result, Exception)}
+    try:
+        dropped = drop_all_tables_in_schema(conn, str(schema), keep=fetched)
+        logger.info("Schema %s: tabelas removidas=%s", schema, dropped)
+    except Exception as e:
+        conn.rollback()
+        logger.exception("Falha ao dropar tabelas do schema '%s': %s", schema, e)
+        return _AUTH_CACHE.get(key), fetch_state
+
+    new_state: Dict[str, Dict[str, Any]] = {}
+    loaded = set()
+    for (endpoint_name, table), result in zip(targets, payloads):
+        if isinstance(result, Exception):
+            logger.error("Erro endpoint '%s' cliente '%s': %s", endpoint_name, name, result, exc_info=result)
+            continue
+
+        if endpoint_name in unchanged:
+            logger.info("Sem alterações, tabela mantida | %s.%s", schema, table)
+            new_state[endpoint_name] = known[endpoint_name]
+            continue
+
+        if result["not_modified"]:
+            # 304 sem o payload anterior em mãos: não há o que gravar, a tabela é recarregada no próximo ciclo
+            logger.error("Endpoint '%s' cliente '%s' respondeu 304 mas a tabela precisa ser recarregada.", endpoint_name, name)
+            continue
+
+        try:
+            rows = extract_rows_from_payload(result["payload"])
+
+            inserted = insert_rows_batch(
+                conn=conn,
+                schema=str(schema),
+                table=table,
+                endpoint=endpoint_name,
+                rows=rows,
+                recreate_table_each_run=table not in loaded,
+                logger=logger,
+                unlogged=unlogged_tables
+            )
+
+            loaded.add(table)
+            logger.info("Gravação COLUNAR OK | %s.%s | linhas=%s", schema, table, inserted)
+            new_state[endpoint_name] = {"table": table, "sha256": result["sha256"], "etag": result["etag"]}
+
+        except Exception as e:
+            conn.rollback()
+            logger.exception("Erro endpoint '%s' cliente '%s': %s", endpoint_name, name, e)
+
+    return _AUTH_CACHE.get(key), new_state
+
+def new_client_pool() -> ProcessPoolExecutor:
+    # clientes são independentes (schemas e sessões próprios): um processo por cliente, até MAX_CLIENT_WORKERS.
+    # o pool vive entre os ciclos para cada processo manter sua conexão com o banco
+    return ProcessPoolExecutor(
+        max_workers=MAX_CLIENT_WORKERS,
+        initializer=setup_worker_logger,
+        initargs=(_LOG_QUEUE,)
+    )
+
+
+def run_cycle(logger: logging.Logger, conn: psycopg.Connection, pool: ProcessPoolExecutor) -> None:
     load_dotenv()
 
     base_url = os.getenv("API_BASE_URL", "").rstrip("/")
@@ -108,106 +413,59 @@ def run_cycle(logger: logging.Logger) -> None:
     if not verify_ssl:
         urllib3.disable_warnings(InsecureRequestWarning)
 
+    session_ttl = max(60, int(os.getenv("API_SESSION_TTL_MINUTES", "60")) * 60)
+
     clients = load_clients("clients.yml")
     if not clients:
         logger.warning("Nenhum cliente encontrado em clients.yml")
         return
 
     conninfo = pg_conninfo_from_env()
+    unlogged_tables = env_bool("PG_UNLOGGED_TABLES", default=False)
+
+    keep = [str(c.get("schema", "")).strip() for c in clients]
+    removed = drop_orphan_schemas(conn, keep, logger)
+    if removed:
+        logger.info("Schemas órfãos removidos: %s", removed)
+    else:
+        logger.info("Nenhum schema órfão para remover.")
+
+    # estado só dos schemas ainda configurados; os demais foram removidos como órfãos
+    saved = load_fetch_state()
+    fetch_state = {s: saved.get(s, {}) for s in keep if s}
+
+    futures = {}
+    for c in clients:
+        key = (str(c.get("usuario")), str(c.get("identificador")))
+        schema = str(c.get("schema", "")).strip()
+        fut = pool.submit(
+            _process_client, c, base_url, verify_ssl, conninfo, unlogged_tables, session_ttl,
+            _AUTH_CACHE.get(key), fetch_state.get(schema, {})
+        )
+        futures[fut] = (c.get("name", "SemNome"), key, schema)
+
+    for fut in as_completed(futures):
+        name, key, schema = futures[fut]
+        try:
+            auth, client_state = fut.result()
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            logger.exception("Erro no processamento do cliente '%s': %s", name, e)
+            fetch_state.pop(schema, None)
+            continue
 
-    with psycopg.connect(conninfo) as conn:
-        keep = [str(c.get("schema", "")).strip() for c in clients]
-        removed = drop_orphan_schemas(conn, keep, logger)
-        if removed:
-            logger.info(f"Schemas órfãos removidos: {removed}")
+        if auth:
+            _AUTH_CACHE[key] = auth
         else:
-            logger.info("Nenhum schema órfão para remover.")
-
-        for c in clients:
-            name = c.get("name", "SemNome")
-            schema = c.get("schema")
-            usuario = c.get("usuario")
-            senha = c.get("senha")
-            identificador = c.get("identificador")
-            endpoints = c.get("endpoints", [])
-
-            if not all([schema, usuario, senha, identificador]):
-                logger.error(f"Cliente '{name}' inválido (faltando schema/usuario/senha/identificador). Pulando.")
-                continue
-            if not endpoints:
-                logger.warning(f"Cliente '{name}' sem endpoints. Pulando.")
-                continue
-
-            logger.info(f"=== Cliente: {name} | schema={schema} ===")
+            _AUTH_CACHE.pop(key, None)
 
-            try:
-                auth = api_login(
-                    base_url=base_url,
-                    usuario=str(usuario),
-                    senha=str(senha),
-                    identificador=str(identificador),
-                    verify_ssl=verify_ssl,
-                    logger=logger
-                )
-            except Exception as e:
-                logger.exception(f"Falha no login do cliente '{name}': {e}")
-                continue
-
-            sessao = auth["sessao"]
-            idUsuario = auth["idUsuario"]
-            ident = auth["identificador"]
-
-            try:
-                dropped = drop_all_tables_in_schema(conn, str(schema))
-                logger.info(f"Schema {schema}: tabelas removidas={dropped}")
-            except Exception as e:
-                logger.exception(f"Falha ao dropar tabelas do schema '{schema}': {e}")
-                continue
-
-            for ep in endpoints:
-                try:
-                    if isinstance(ep, str):
-                        endpoint_name = ep
-                        table = table_name_from_endpoint(endpoint_name)
-                    elif isinstance(ep, dict):
-                        endpoint_name = str(ep.get("endpoint", "")).strip()
-                        custom_table = str(ep.get("table", "")).strip()
-
-                        if not endpoint_name:
-                            logger.error(f"Endpoint inválido no yml (faltando 'endpoint') no cliente '{name}'. Pulando.")
-                            continue
-
-                        table = custom_table if custom_table else table_name_from_endpoint(endpoint_name)
-                    else:
-                        logger.error(f"Formato inválido em endpoints no cliente '{name}': {ep}. Pulando.")
-                        continue
-
-                    payload = api_fetch_endpoint(
-                        base_url=base_url,
-                        endpoint=str(endpoint_name),
-                        sessao=sessao,
-                        idUsuario=idUsuario,
-                        identificador=ident,
-                        verify_ssl=verify_ssl,
-                        logger=logger
-                    )
-
-                    rows = extract_rows_from_payload(payload)
-
-                    inserted = insert_rows_batch(
-                        conn=conn,
-                        schema=str(schema),
-                        table=str(table),
-                        endpoint=str(endpoint_name),
-                        rows=rows,
-                        batch_size=500,
-                        recreate_table_each_run=False 
-                    )
-
-                    logger.info(f"Gravação COLUNAR OK | {schema}.{table} | linhas={inserted}")
-
-                except Exception as e:
-                    logger.exception(f"Erro endpoint '{ep}' cliente '{name}': {e}")
+        if schema:
+            fetch_state[schema] = client_state
+        try:
+            save_fetch_state(fetch_state)
+        except OSError as e:
+            logger.exception("Falha ao salvar %s: %s", FETCH_STATE_PATH, e)
 
 
 def main():
@@ -218,20 +476,42 @@ def main():
     seconds = max(60, minutes * 60)
 
     logger.info("Iniciando ETL (multi-client / schemas).")
-    logger.info(f"Agendamento: a cada {minutes} minuto(s).")
-
-    while True:
-        start = time.time()
-        try:
-            run_cycle(logger)
-        except Exception as e:
-            logger.exception(f"Erro geral do ciclo: {e}")
+    logger.info("Agendamento: a cada %s minuto(s).", minutes)
 
-        elapsed = time.time() - start
-        sleep_for = max(1, seconds - elapsed)
-        logger.info(f"Ciclo finalizado em {elapsed:.1f}s. Próxima execução em {sleep_for:.0f}s.")
-        time.sleep(sleep_for)
+    # conexão e pool de processos ficam abertos entre os ciclos
+    conn: Optional[psycopg.Connection] = None
+    pool: Optional[ProcessPoolExecutor] = None
 
+    try:
+        while True:
+            start = time.time()
+            try:
+                conn = pg_ensure_connection(conn, pg_conninfo_from_env())
+                if pool is None:
+                    pool = new_client_pool()
+                run_cycle(logger, conn, pool)
+            except (psycopg.OperationalError, psycopg.InterfaceError) as e:
+                logger.exception("Conexão com o PostgreSQL perdida, reconectando no próximo ciclo: %s", e)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            except BrokenProcessPool as e:
+                logger.exception("Pool de processos quebrado, recriando no próximo ciclo: %s", e)
+                pool.shutdown(wait=False, cancel_futures=True)
+                pool = None
+            except Exception as e:
+                logger.exception("Erro geral do ciclo: %s", e)
+
+            elapsed = time.time() - start
+            sleep_for = max(1, seconds - elapsed)
+            logger.info("Ciclo finalizado em %.1fs. Próxima execução em %.0fs.", elapsed, sleep_for)
+            time.sleep(sleep_for)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        if conn is not None:
+            conn.close()
+        stop_logger()
 
 if __name__ == "__main__":
     main()
@@ -1,10 +1,41 @@
 import json
+import logging
 import re
+from datetime import datetime, timedelta, timezone, tzinfo
 from decimal import Decimal
-from typing import Any, Dict, List
+from functools import lru_cache, partial
+from itertools import islice
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import psycopg
 from psycopg import sql
+from psycopg.types.json import Jsonb
+
+# abaixo disso o COPY não compensa; usa INSERT com executemany
+COPY_MIN_ROWS = 50
+
+# linhas usadas para inferir os tipos das colunas antes de começar o COPY
+TYPE_SAMPLE_ROWS = 256
+
+# colunas de controle criadas por ensure_table_base
+BASE_COLUMNS = ("_id", "_fetched_at", "_endpoint")
+
+# tipo inferido -> tipo do psycopg usado no COPY binário
+BINARY_COPY_TYPES = {
+    "bigint": "int8",
+    "numeric": "numeric",
+    "timestamptz": "timestamptz",
+    "boolean": "bool",
+    "jsonb": "jsonb",
+    "varchar(255)": "varchar",
+    "text": "text",
+}
+
+_BAD = re.compile(r"[^a-zA-Z0-9_]+")
+_MULTI = re.compile(r"_+")
+_TS = re.compile(
+    r"^(\d{4})-(\d{2})-(\d{2})(?:[ T](\d{2}):(\d{2}):(\d{2})(?:\.(\d+))?(Z)?)?$"
+)
 
 
 def pg_conninfo_from_env() -> str:
@@ -19,6 +50,26 @@ def pg_conninfo_from_env() -> str:
     return f"host={host} port={port} dbname={db} user={user} password={pwd}"
 
 
+def pg_connect(conninfo: str) -> psycopg.Connection:
+    # comandos repetidos na mesma sessão passam a ser prepared statements no servidor a partir da 2ª execução
+    return psycopg.connect(conninfo, prepare_threshold=1, autocommit=False)
+
+
+def pg_ensure_connection(conn: Optional[psycopg.Connection], conninfo: str) -> psycopg.Connection:
+    # reaproveita a conexão entre ciclos; SELECT 1 confirma que ela segue viva, senão reconecta.
+    # o rollback descarta transação que tenha ficado aberta/abortada no ciclo anterior
+    if conn is not None and not conn.closed:
+        try:
+            conn.rollback()
+            conn.execute("SELECT 1")
+            conn.commit()
+            return conn
+        except (psycopg.OperationalError, psycopg.InterfaceError):
+            conn.close()
+    return pg_connect(conninfo)
+
+
+@lru_cache(maxsize=256)
 def table_name_from_endpoint(endpoint: str) -> str:
     out = []
     for i, ch in enumerate(endpoint):
@@ -29,9 +80,10 @@ def table_name_from_endpoint(endpoint: str) -> str:
     return f"api_{name}"
 
 
+@lru_cache(maxsize=8192)
 def sanitize_col(name: str) -> str:
-    name = re.sub(r"[^a-zA-Z0-9_]+", "_", str(name).strip())
-    name = re.sub(r"_+", "_", name).strip("_").lower()
+    name = _BAD.sub("_", str(name).strip())
+    name = _MULTI.sub("_", name).strip("_").lower()
     if not name:
         name = "col"
     if name[0].isdigit():
@@ -39,25 +91,85 @@ def sanitize_col(name: str) -> str:
     return name[:63]
 
 
-def flatten_json(obj: dict, parent_key: str = "", sep: str = "_") -> dict:
+def flatten_json(obj: dict, sep: str = "_") -> dict:
+    # pilha explícita no lugar da recursão: (prefixo já sanitizado, iterador do dict).
+    # cada dict aninhado é percorrido na hora, na mesma ordem da recursão, então em chaves
+    # que colidem depois de sanitizadas continua valendo a última escrita
     items = {}
-    for k, v in (obj or {}).items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else str(k)
-        new_key = sanitize_col(new_key)
-
-        if isinstance(v, dict):
-            items.update(flatten_json(v, new_key, sep=sep))
-        elif isinstance(v, list):
-            items[new_key] = v  # fica jsonb
+    stack = [("", iter((obj or {}).items()))]
+    while stack:
+        parent_key, it = stack[-1]
+        for k, v in it:
+            new_key = sanitize_col(f"{parent_key}{sep}{k}" if parent_key else str(k))
+
+            if isinstance(v, dict):
+                stack.append((new_key, iter(v.items())))
+                break
+            items[new_key] = v  # listas ficam jsonb
         else:
-            items[new_key] = v
+            stack.pop()
     return items
 
 
 def try_parse_timestamp(s: str) -> bool:
     if not isinstance(s, str):
         return False
-    return bool(re.match(r"^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}:\d{2}(\.\d+)?(Z)?)?$", s))
+    return bool(_TS.match(s))
+
+
+def parse_timestamp(s: str, tz: tzinfo) -> datetime:
+    # sem "Z" usa o fuso da sessão, como o Postgres faria com o texto
+    m = _TS.match(s)
+    if not m:
+        raise ValueError(f"Timestamp inválido: {s!r}")
+    y, mo, d, h, mi, sec, frac, z = m.groups()
+    h, mi, sec = int(h or 0), int(mi or 0), int(sec or 0)
+    # mesmas regras do Postgres: fração arredondada (rint) em microssegundos, 24:00:00 e
+    # segundo 60 aceitos e somados à data, em vez do ValueError do datetime
+    usec = round(float(f".{frac}") * 1_000_000) if frac else 0
+    day_usec = ((h * 60 + mi) * 60 + sec) * 1_000_000 + usec
+    if mi > 59 or sec > 60 or (h == 24 and (mi or sec or usec)) or day_usec > 86_400_000_000:
+        raise ValueError(f"Timestamp inválido: {s!r}")
+    return datetime(int(y), int(mo), int(d), tzinfo=timezone.utc if z else tz) + timedelta(
+        hours=h, minutes=mi, seconds=sec, microseconds=usec
+    )
+
+
+def _to_decimal(v: Any) -> Decimal:
+    return v if isinstance(v, Decimal) else Decimal(str(v))
+
+
+def _to_text(v: Any) -> str:
+    if isinstance(v, str):
+        return v
+    return str(v).lower() if isinstance(v, bool) else str(v)
+
+
+def _to_json_text(v: Any) -> str:
+    return json.dumps(v, ensure_ascii=False)
+
+
+def text_converter(pg_type: str, existing_type: Optional[str] = None) -> Optional[Callable[[Any], Any]]:
+    # conversão aplicada a valores não nulos no INSERT e no COPY texto. bool em coluna texto vira
+    # 'true'/'false', como no cast bool -> text do Postgres e no COPY binário, e não 't'/'f'
+    if pg_type == "jsonb":
+        return _to_json_text
+    if pg_type in ("varchar(255)", "text") or existing_type in ("varchar", "text"):
+        return _to_text
+    return None
+
+
+def binary_copy_converter(pg_type: str, tz: tzinfo) -> Optional[Callable[[Any], Any]]:
+    # conversão aplicada a valores não nulos da coluna no COPY binário; None = valor vai como está
+    if pg_type == "jsonb":
+        return Jsonb
+    if pg_type == "numeric":
+        return _to_decimal
+    if pg_type == "timestamptz":
+        return partial(parse_timestamp, tz=tz)
+    if pg_type in ("varchar(255)", "text"):
+        return _to_text
+    return None
 
 
 def infer_pg_type(value: Any) -> str:
@@ -97,21 +209,20 @@ def unify_types(t1: str, t2: str) -> str:
 def ensure_schema(conn: psycopg.Connection, schema: str) -> None:
     with conn.cursor() as cur:
         cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
-    conn.commit()
 
 
-def drop_table_if_exists(conn: psycopg.Connection, schema: str, table: str) -> None:
+def drop_table_if_exists(conn: psycopg.Connection, schema: str, table: str, cascade: bool = False) -> None:
     with conn.cursor() as cur:
         cur.execute(
-            sql.SQL("DROP TABLE IF EXISTS {}.{}").format(
+            sql.SQL("DROP TABLE IF EXISTS {}.{}{}").format(
                 sql.Identifier(schema),
-                sql.Identifier(table)
+                sql.Identifier(table),
+                sql.SQL(" CASCADE" if cascade else "")
             )
         )
-    conn.commit()
 
 
-def drop_all_tables_in_schema(conn: psycopg.Connection, schema: str) -> int:
+def list_tables_in_schema(conn: psycopg.Connection, schema: str) -> List[str]:
     with conn.cursor() as cur:
         cur.execute(
             """
@@ -121,24 +232,30 @@ def drop_all_tables_in_schema(conn: psycopg.Connection, schema: str) -> int:
             """,
             (schema,)
         )
-        tables = [r[0] for r in cur.fetchall()]
+        return [r[0] for r in cur.fetchall()]
+
+
+def drop_all_tables_in_schema(conn: psycopg.Connection, schema: str, keep: Iterable[str] = ()) -> int:
+    keep = set(keep)
+    tables = [t for t in list_tables_in_schema(conn, schema) if t not in keep]
 
     if not tables:
+        conn.commit()
         return 0
 
-    dropped = 0
+    # uma única DDL com a lista inteira: um parse e um lote de locks em vez de um DROP por tabela
     with conn.cursor() as cur:
-        for t in tables:
-            cur.execute(
-                sql.SQL("DROP TABLE IF EXISTS {}.{} CASCADE").format(
-                    sql.Identifier(schema),
-                    sql.Identifier(t)
+        cur.execute(
+            sql.SQL("DROP TABLE IF EXISTS {} CASCADE").format(
+                sql.SQL(", ").join(
+                    sql.SQL("{}.{}").format(sql.Identifier(schema), sql.Identifier(t))
+                    for t in tables
                 )
             )
-            dropped += 1
+        )
 
     conn.commit()
-    return dropped
+    return len(tables)
 
 
 def ensure_table_base(conn: psycopg.Connection, schema: str, table: str) -> None:
@@ -150,7 +267,48 @@ def ensure_table_base(conn: psycopg.Connection, schema: str, table: str) -> None
                 _endpoint TEXT NOT NULL
             )
         """).format(sql.Identifier(schema), sql.Identifier(table)))
-    conn.commit()
+
+
+def staging_table_name(table: str) -> str:
+    # cabe nos 63 caracteres de identificador do PostgreSQL
+    return f"{table[:59]}_stg"
+
+
+def create_table(
+    conn: psycopg.Connection,
+    schema: str,
+    table: str,
+    columns: List[Tuple[str, str]],
+    unlogged: bool = False
+) -> None:
+    # colunas base + todas as inferidas num único CREATE; a chave primária só é criada depois da carga
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("""
+            CREATE {}TABLE {}.{} (
+                _id BIGSERIAL,
+                _fetched_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                _endpoint TEXT NOT NULL{}
+            )
+        """).format(
+            sql.SQL("UNLOGGED " if unlogged else ""),
+            sql.Identifier(schema),
+            sql.Identifier(table),
+            sql.SQL("").join(
+                sql.SQL(", {} {}").format(sql.Identifier(col), sql.SQL(pg_type))
+                for col, pg_type in columns
+            )
+        ))
+
+
+def replace_table(conn: psycopg.Connection, schema: str, staging: str, table: str) -> None:
+    drop_table_if_exists(conn, schema, table, cascade=True)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE {}.{} RENAME TO {}").format(
+            sql.Identifier(schema), sql.Identifier(staging), sql.Identifier(table)
+        ))
+        cur.execute(sql.SQL("ALTER TABLE {}.{} ADD PRIMARY KEY (_id)").format(
+            sql.Identifier(schema), sql.Identifier(table)
+        ))
 
 
 def get_existing_columns(conn: psycopg.Connection, schema: str, table: str) -> Dict[str, str]:
@@ -159,25 +317,50 @@ def get_existing_columns(conn: psycopg.Connection, schema: str, table: str) -> D
             SELECT column_name, udt_name
             FROM information_schema.columns
             WHERE table_schema = %s AND table_name = %s
-        """, (schema, table))
+        """, (schema, table), prepare=True)
         rows = cur.fetchall()
     return {r[0]: r[1] for r in rows}
 
 
-def add_column(conn: psycopg.Connection, schema: str, table: str, col: str, pg_type: str) -> None:
+def add_columns(conn: psycopg.Connection, schema: str, table: str, columns: List[Tuple[str, str]]) -> None:
+    if not columns:
+        return
     with conn.cursor() as cur:
         cur.execute(
-            sql.SQL("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS {} {}").format(
+            sql.SQL("ALTER TABLE {}.{} ").format(
                 sql.Identifier(schema),
-                sql.Identifier(table),
-                sql.Identifier(col),
-                sql.SQL(pg_type)
+                sql.Identifier(table)
+            ) + sql.SQL(", ").join(
+                sql.SQL("ADD COLUMN IF NOT EXISTS {} {}").format(sql.Identifier(col), sql.SQL(pg_type))
+                for col, pg_type in columns
+            )
+        )
+
+
+def alter_column_types(conn: psycopg.Connection, schema: str, table: str, columns: List[Tuple[str, str]]) -> None:
+    if not columns:
+        return
+
+    def using(col: str, pg_type: str) -> sql.Composable:
+        if pg_type == "jsonb":
+            return sql.SQL("to_jsonb({})").format(sql.Identifier(col))
+        return sql.SQL("{}::{}").format(sql.Identifier(col), sql.SQL(pg_type))
+
+    with conn.cursor() as cur:
+        cur.execute(
+            sql.SQL("ALTER TABLE {}.{} ").format(
+                sql.Identifier(schema),
+                sql.Identifier(table)
+            ) + sql.SQL(", ").join(
+                sql.SQL("ALTER COLUMN {} TYPE {} USING {}").format(
+                    sql.Identifier(col), sql.SQL(pg_type), using(col, pg_type)
+                )
+                for col, pg_type in columns
             )
         )
-    conn.commit()
 
 
-def extract_rows_from_payload(payload: Any) -> List[Dict[str, Any]]:
+def extract_rows_from_payload(payload: Any) -> Iterator[Dict[str, Any]]:
     if isinstance(payload, dict) and "dados" in payload and isinstance(payload["dados"], list):
         data = payload["dados"]
     elif isinstance(payload, list):
@@ -187,79 +370,187 @@ def extract_rows_from_payload(payload: Any) -> List[Dict[str, Any]]:
     else:
         data = [{"valor": payload}]
 
-    rows: List[Dict[str, Any]] = []
+    # gera as linhas sob demanda, sem montar a lista achatada inteira; o payload não é alterado
     for item in data:
-        if isinstance(item, dict):
-            rows.append(flatten_json(item))
-        else:
-            rows.append({"valor": item})
-    return rows
+        yield flatten_json(item) if isinstance(item, dict) else {"valor": item}
 
 
-def insert_rows_batch(
+def infer_column_types(
+    rows: Iterable[Dict[str, Any]],
+    col_types: Optional[Dict[str, Optional[str]]] = None
+) -> Dict[str, Optional[str]]:
+    # uma única passada; coluna só com nulos fica None (vira text na criação)
+    col_types = {} if col_types is None else col_types
+    for r in rows:
+        for c, v in r.items():
+            current = col_types.get(c)
+            if v is None:
+                col_types[c] = current
+                continue
+            t = infer_pg_type(v)
+            col_types[c] = t if current is None else unify_types(current, t)
+
+    for c in BASE_COLUMNS:
+        col_types.pop(c, None)
+    return col_types
+
+
+def row_fits_types(r: Dict[str, Any], col_types: Dict[str, Optional[str]]) -> bool:
+    for c, v in r.items():
+        if c not in col_types:
+            if c in BASE_COLUMNS:
+                continue
+            return False
+        if v is None:
+            continue
+        current = col_types[c]
+        if current is None or unify_types(current, infer_pg_type(v)) != current:
+            return False
+    return True
+
+
+def _write_rows(
     conn: psycopg.Connection,
+    cur: psycopg.Cursor,
     schema: str,
     table: str,
     endpoint: str,
-    rows: List[Dict[str, Any]],
-    batch_size: int = 500,
-    recreate_table_each_run: bool = True
+    col_types: Dict[str, Optional[str]],
+    rows: Iterable[Dict[str, Any]],
+    use_copy: bool,
+    binary_copy: bool,
+    existing: Optional[Dict[str, str]] = None
 ) -> int:
-    if not rows:
-        return 0
+    all_cols = sorted(col_types)
+    types = {c: col_types[c] or "text" for c in all_cols}
+    target = (
+        sql.Identifier(schema),
+        sql.Identifier(table),
+        sql.SQL(", ").join(map(sql.Identifier, ["_endpoint"] + all_cols)),
+    )
 
-    all_cols = set()
-    for r in rows:
-        all_cols.update(r.keys())
-    all_cols = [c for c in sorted(all_cols) if c not in ("_id", "_fetched_at", "_endpoint")]
+    def row_values(r: Dict[str, Any], columns: List[Tuple[str, Optional[Callable[[Any], Any]]]]) -> List[Any]:
+        row_vals = [endpoint]
+        append = row_vals.append
+        for c, conv in columns:
+            v = r.get(c)
+            if v is not None and conv is not None:
+                v = conv(v)
+            append(v)
+        return row_vals
 
-    col_types: Dict[str, str] = {}
-    for c in all_cols:
-        current = None
-        for r in rows:
-            if c in r and r[c] is not None:
-                t = infer_pg_type(r[c])
-                current = t if current is None else unify_types(current, t)
-        col_types[c] = current or "text"
+    # conversões resolvidas uma vez por coluna, fora do laço das linhas
+    existing = existing or {}
+    text_columns = [(c, text_converter(types[c], existing.get(c))) for c in all_cols]
 
-    ensure_schema(conn, schema)
+    total = 0
+    if not use_copy:
+        insert_sql = sql.SQL("INSERT INTO {}.{} ({}) VALUES ({})").format(
+            *target,
+            sql.SQL(", ").join([sql.Placeholder()] * (len(all_cols) + 1))
+        )
+        values = [row_values(r, text_columns) for r in rows]
+        cur.executemany(insert_sql, values)
+        return len(values)
+
+    # o COPY binário não converte no servidor: coluna já existente com outro tipo (udt_name)
+    # exige o COPY texto, que o Postgres converte como faria com o INSERT
+    if binary_copy and all(
+        types[c] in BINARY_COPY_TYPES and existing.get(c, BINARY_COPY_TYPES[types[c]]) == BINARY_COPY_TYPES[types[c]]
+        for c in all_cols
+    ):
+        tz = conn.info.timezone
+        columns = [(c, binary_copy_converter(types[c], tz)) for c in all_cols]
+        copy_sql = sql.SQL("COPY {}.{} ({}) FROM STDIN WITH (FORMAT BINARY)").format(*target)
+        with cur.copy(copy_sql) as cp:
+            cp.set_types(["text"] + [BINARY_COPY_TYPES[types[c]] for c in all_cols])
+            for r in rows:
+                cp.write_row(row_values(r, columns))
+                total += 1
+    else:
+        copy_sql = sql.SQL("COPY {}.{} ({}) FROM STDIN").format(*target)
+        with cur.copy(copy_sql) as cp:
+            for r in rows:
+                cp.write_row(row_values(r, text_columns))
+                total += 1
+    return total
 
-    if recreate_table_each_run:
-        drop_table_if_exists(conn, schema, table)
 
-    ensure_table_base(conn, schema, table)
+def insert_rows_batch(
+    conn: psycopg.Connection,
+    schema: str,
+    table: str,
+    endpoint: str,
+    rows: Iterable[Dict[str, Any]],
+    recreate_table_each_run: bool = True,
+    binary_copy: bool = True,
+    logger: Optional[logging.Logger] = None,
+    unlogged: bool = False
+) -> int:
+    # os tipos saem de uma amostra; o restante das linhas vai direto para o COPY, sem ser acumulado
+    it = iter(rows)
+    sample = list(islice(it, TYPE_SAMPLE_ROWS))
+    if not sample:
+        if recreate_table_each_run:
+            drop_table_if_exists(conn, schema, table, cascade=True)
+            conn.commit()
+        return 0
 
-    existing = get_existing_columns(conn, schema, table)
-    for c in all_cols:
-        if c not in existing:
-            add_column(conn, schema, table, c, col_types[c])
+    col_types = infer_column_types(sample)
+    all_cols = sorted(col_types)
 
-    base_cols = ["_endpoint"] + all_cols
+    # na recriação a carga vai para uma tabela nova, já com todas as colunas, que substitui a atual
+    # no fim da mesma transação: quem lê a tabela nunca a vê vazia ou pela metade
+    existing: Dict[str, str] = {}
+    target = staging_table_name(table) if recreate_table_each_run else table
 
-    insert_sql = sql.SQL("INSERT INTO {}.{} ({}) VALUES ({})").format(
-        sql.Identifier(schema),
-        sql.Identifier(table),
-        sql.SQL(", ").join(map(sql.Identifier, base_cols)),
-        sql.SQL(", ").join([sql.Placeholder()] * len(base_cols))
-    )
+    # DDL em pipeline; o COPY não é suportado em pipeline e roda depois, na mesma transação
+    with conn.pipeline():
+        ensure_schema(conn, schema)
+
+        if recreate_table_each_run:
+            create_table(conn, schema, target, [(c, col_types[c] or "text") for c in all_cols], unlogged)
+        else:
+            ensure_table_base(conn, schema, table)
+            existing = get_existing_columns(conn, schema, table)
+            add_columns(conn, schema, table, [(c, col_types[c] or "text") for c in all_cols if c not in existing])
 
-    total = 0
     with conn.cursor() as cur:
-        for i in range(0, len(rows), batch_size):
-            chunk = rows[i:i + batch_size]
-            values = []
-
-            for r in chunk:
-                row_vals = [endpoint]
-                for c in all_cols:
-                    v = r.get(c)
-                    if isinstance(v, (dict, list)):
-                        v = json.dumps(v, ensure_ascii=False)
-                    row_vals.append(v)
-                values.append(tuple(row_vals))
-
-            cur.executemany(insert_sql, values)
-            total += len(chunk)
+        if len(sample) < COPY_MIN_ROWS:
+            total = _write_rows(conn, cur, schema, target, endpoint, col_types, sample, False, binary_copy, existing)
+        else:
+            # linhas fora dos tipos da amostra (coluna nova ou tipo mais largo) ficam para depois
+            overflow: List[Dict[str, Any]] = []
+
+            def fitting_rows() -> Iterator[Dict[str, Any]]:
+                yield from sample
+                for r in it:
+                    if row_fits_types(r, col_types):
+                        yield r
+                    else:
+                        overflow.append(r)
+
+            total = _write_rows(conn, cur, schema, target, endpoint, col_types, fitting_rows(), True, binary_copy, existing)
+
+            if overflow:
+                widened = infer_column_types(overflow, dict(col_types))
+                new_cols = [c for c in sorted(widened) if c not in col_types and c not in existing]
+                changed = [
+                    (c, widened[c] or "text") for c in all_cols
+                    if c not in existing and (widened[c] or "text") != (col_types[c] or "text")
+                ]
+                if logger:
+                    logger.warning(
+                        "%s.%s: %s linha(s) fora dos tipos da amostra; colunas novas=%s alteradas=%s",
+                        schema, table, len(overflow), new_cols, changed
+                    )
+                add_columns(conn, schema, target, [(c, widened[c] or "text") for c in new_cols])
+                alter_column_types(conn, schema, target, changed)
+                total += _write_rows(conn, cur, schema, target, endpoint, widened, overflow, True, binary_copy, existing)
+
+    if recreate_table_each_run:
+        with conn.pipeline():
+            replace_table(conn, schema, target, table)
 
     conn.commit()
     return total